@@ -5,17 +5,50 @@
 
 # Required Libraries:
 # 1. pyTelegramBotAPI (install via pip: pip install pyTelegramBotAPI)
+#    (version 4.x required for apihelper.CUSTOM_REQUEST_SENDER; tested with 4.36.1)
 # 2. bakong-khqr (install via pip: pip install bakong-khqr[image])
 #    (The [image] dependency installs Pillow and qrcode for image generation)
+# 3. flask (optional, install via pip: pip install flask)
+#    (Only needed if PAYMENT_WEBHOOK_URL is set for push payment notifications)
+# 4. redis (optional, install via pip: pip install redis)
+#    (Only needed if REDIS_URL is set to persist transactions across restarts)
 
 import telebot
 import os
 import io
 import time
+import base64
+import contextlib
+import hashlib
+import requests
+import heapq
+import itertools
 import threading
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 # Import necessary types for inline keyboard
-from telebot import types 
-from bakong_khqr import KHQR 
+from telebot import types
+from bakong_khqr import KHQR
+
+# Flask is only required when running with a payment webhook (see PAYMENT_WEBHOOK_URL)
+try:
+    from flask import Flask, request as flask_request
+except ImportError:
+    Flask = None
+
+# redis is only required when persisting transactions (see REDIS_URL)
+try:
+    import redis as redis_lib
+except ImportError:
+    redis_lib = None
+
+# Pillow ships with bakong-khqr[image]; used to re-encode QR images as WebP
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # --- 1. CONFIGURATION ---
 # IMPORTANT: REPLACE THESE PLACEHOLDERS WITH YOUR REAL CREDENTIALS
@@ -29,20 +62,264 @@ MERCHANT_NAME = "YOUR NAME"
 MERCHANT_CITY = "Phnom Penh"
 CURRENCY = "KHR" # Or 'USD'
 
+# Public URL Bakong should POST payment notifications to (e.g. via an ngrok tunnel).
+# Leave empty to run in polling-only mode. When set, the poll thread drops to a
+# slow reconciliation cadence and PAID events arrive as pushes instead.
+PAYMENT_WEBHOOK_URL = ""
+# Public URL Telegram should POST bot updates to. Leave empty to use getUpdates
+# long-polling; when set, the bot registers a webhook and Telegram pushes
+# updates to the flask server instead of the bot polling for them.
+TELEGRAM_WEBHOOK_URL = ""
+# Local port the webhook server listens on (shared by both endpoints)
+WEBHOOK_PORT = 8080
+
+# Redis connection URL (e.g. 'redis://localhost:6379/0'). Leave empty to keep
+# transactions in process memory. When set, transactions survive restarts and
+# can be shared by multiple bot workers: records live in hashes under
+# 'khqr:tx:<bill>' and expiry deadlines in the 'khqr:expiry' sorted set, so
+# the expiry sweep is a single ZRANGEBYSCORE instead of a Python-level scan.
+REDIS_URL = ""
+
 # --- GLOBAL STATE & CONSTANTS ---
 # Time constant for expiration (5 minutes)
 EXPIRATION_SECONDS = 5 * 60 
 # Interval for checking payment status (30 seconds)
-CHECK_INTERVAL_SECONDS = 30 
-# Callback data prefix for the confirm button
-CONFIRM_CALLBACK_PREFIX = "confirm_"
-
-# Dictionary to store active dynamic transactions for status checking and cleanup
-# Format: { bill_number: { 'md5_hash': str, 'expiry_time': float, 'chat_id': int, 'message_id': int } }
-active_transactions = {}
-
-# Lock for safely modifying the active_transactions dictionary across threads
-transaction_lock = threading.Lock()
+CHECK_INTERVAL_SECONDS = 30
+# Slow reconciliation interval used when the payment webhook is active (5 minutes);
+# the poll only catches notifications the webhook missed
+RECONCILE_INTERVAL_SECONDS = 5 * 60
+# The confirm button carries the bill id as 8 bytes of urlsafe base64 (11 chars
+# once padding is stripped), well under Telegram's 64-byte callback_data cap;
+# the handler dispatches on this exact length instead of a prefix scan
+BILL_CALLBACK_LEN = 11
+
+# Caption for the QR photo, assembled once at import time so each /pay only
+# fills in the varying fields; CURRENCY never changes and is baked in directly
+QR_CAPTION_TEMPLATE = (
+    "💰 **អាចទូទាត់ជាមួយ KHQR ខាងលើបាន**\n"
+    "ទឹកប្រាក់ចំនួន **{amount:.2f} " + CURRENCY + "**\n"
+    "គោលបំណង: {description}\n"
+    "លេខបង្កាន់ដៃ: `{bill_number}`\n"
+    "⏰ **ផុតកំណត់នៅម៉ោង {expiry_datetime}**\n\n"
+    "✅ **ការទូទាត់នឹងត្រូវបានបញ្ជាក់ដោយស្វ័យប្រវត្តិ ឬចុចប៊ូតុងខាងក្រោម។**"
+)
+
+# Bill numbers are the startup timestamp (ns) plus a monotonic counter, so each
+# /pay needs only an integer increment instead of a float time.time() * 1000
+# conversion, while staying unique across restarts
+_BILL_EPOCH_NS = time.time_ns()
+_bill_counter = itertools.count()
+
+def next_bill_number():
+    """Returns a unique bill number of the form TRX<integer>."""
+    return f"TRX{_BILL_EPOCH_NS + next(_bill_counter)}"
+
+def encode_bill_callback(bill_number):
+    """Packs the integer part of a bill number into BILL_CALLBACK_LEN base64 chars."""
+    bill_id = int(bill_number[3:])  # strip the 'TRX' prefix
+    return base64.urlsafe_b64encode(bill_id.to_bytes(8, 'big')).rstrip(b'=').decode()
+
+def decode_bill_callback(callback_data):
+    """Inverse of encode_bill_callback, restoring the TRX<integer> bill number."""
+    bill_id = int.from_bytes(base64.urlsafe_b64decode(callback_data + '='), 'big')
+    return f"TRX{bill_id}"
+
+def format_expiry_time(expiry_time):
+    """
+    Formats an epoch timestamp as a 12-hour clock string (e.g. '07:05:09 PM').
+    Hand-formatted from datetime attributes to skip the strftime locale machinery.
+    """
+    dt = datetime.fromtimestamp(expiry_time)
+    hour = dt.hour % 12 or 12
+    meridiem = "AM" if dt.hour < 12 else "PM"
+    return f"{hour:02d}:{dt.minute:02d}:{dt.second:02d} {meridiem}"
+
+# Active dynamic transactions for status checking and cleanup, sharded across
+# lock-striped buckets so /pay, the callback handler and the background threads
+# contend on 1/16th of the map instead of convoying on a single mutex.
+# The buckets are copy-on-write: writers build a modified copy under the bucket
+# lock and publish it with one reference assignment (atomic under the GIL), so
+# readers dereference the current bucket without taking any lock at all.
+# When REDIS_URL is set the same accessors read/write Redis instead, so the
+# transactions survive restarts and can be shared across workers.
+# Record format: { 'md5_hash': str, 'expiry_time': float, 'chat_id': int, 'message_id': int }
+TRANSACTION_BUCKETS = 16
+transaction_buckets = [dict() for _ in range(TRANSACTION_BUCKETS)]
+bucket_locks = [threading.Lock() for _ in range(TRANSACTION_BUCKETS)]
+
+# Redis key layout (only used when redis_client is set)
+REDIS_TX_PREFIX = "khqr:tx:"
+REDIS_EXPIRY_KEY = "khqr:expiry"
+# Lease key electing the single worker that runs the background sweeps when
+# several bot processes share one Redis (see the WSGI entry point below)
+REDIS_CLEANER_LOCK_KEY = "khqr:cleaner:lock"
+CLEANER_LEASE_SECONDS = 60
+
+# Identifies this process as a lease holder
+_WORKER_ID = f"{os.getpid()}-{time.time_ns()}"
+
+redis_client = None
+if REDIS_URL:
+    if redis_lib is None:
+        print("REDIS_URL is set but redis is not installed; keeping transactions in memory.")
+    else:
+        redis_client = redis_lib.Redis.from_url(REDIS_URL, decode_responses=True)
+
+def _decode_transaction(mapping):
+    """Restores the native field types of a transaction record read from Redis."""
+    return {
+        'md5_hash': mapping['md5_hash'],
+        'expiry_time': float(mapping['expiry_time']),
+        'chat_id': int(mapping['chat_id']),
+        'message_id': int(mapping['message_id']) if mapping.get('message_id') else None
+    }
+
+def _bucket_index(bill_number):
+    """Maps a bill number to its bucket (TRANSACTION_BUCKETS is a power of two)."""
+    return hash(bill_number) & (TRANSACTION_BUCKETS - 1)
+
+def add_transaction(bill_number, data):
+    """Registers a transaction in its bucket (or in Redis)."""
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.hset(REDIS_TX_PREFIX + bill_number, mapping={k: v for k, v in data.items() if v is not None})
+        pipe.zadd(REDIS_EXPIRY_KEY, {bill_number: data['expiry_time']})
+        pipe.execute()
+        return
+    i = _bucket_index(bill_number)
+    with bucket_locks[i]:
+        updated = dict(transaction_buckets[i])
+        updated[bill_number] = data
+        transaction_buckets[i] = updated
+
+def get_transaction(bill_number):
+    """Returns the transaction record for bill_number, or None if not tracked."""
+    if redis_client is not None:
+        mapping = redis_client.hgetall(REDIS_TX_PREFIX + bill_number)
+        return _decode_transaction(mapping) if mapping else None
+    # Lock-free read: the bucket reference is a published immutable snapshot
+    return transaction_buckets[_bucket_index(bill_number)].get(bill_number)
+
+def pop_transaction(bill_number):
+    """Removes and returns the transaction record, or None if already gone."""
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.hgetall(REDIS_TX_PREFIX + bill_number)
+        pipe.delete(REDIS_TX_PREFIX + bill_number)
+        pipe.zrem(REDIS_EXPIRY_KEY, bill_number)
+        mapping = pipe.execute()[0]
+        return _decode_transaction(mapping) if mapping else None
+    i = _bucket_index(bill_number)
+    with bucket_locks[i]:
+        if bill_number not in transaction_buckets[i]:
+            return None
+        updated = dict(transaction_buckets[i])
+        data = updated.pop(bill_number)
+        transaction_buckets[i] = updated
+        return data
+
+def snapshot_transactions():
+    """Returns a list of (bill_number, data) pairs across all buckets."""
+    if redis_client is not None:
+        bills = redis_client.zrange(REDIS_EXPIRY_KEY, 0, -1)
+        if not bills:
+            return []
+        pipe = redis_client.pipeline()
+        for bill_number in bills:
+            pipe.hgetall(REDIS_TX_PREFIX + bill_number)
+        return [
+            (bill_number, _decode_transaction(mapping))
+            for bill_number, mapping in zip(bills, pipe.execute()) if mapping
+        ]
+    # Lock-free read: each published bucket dict is immutable, so iterating a
+    # grabbed reference is safe while writers swap in fresh copies
+    items = []
+    for bucket in transaction_buckets:
+        items.extend(bucket.items())
+    return items
+
+# Min-heap of (expiry_time, bill_number) so the expiry thread can sleep until
+# the next real deadline instead of scanning every transaction on a timer.
+# Entries whose bill_number is no longer tracked are stale (already
+# paid/removed) and are skipped lazily when popped.
+expiry_heap = []
+
+# Event used to wake the expiry thread when a new transaction is registered
+# (e.g. when the heap was empty and the thread is sleeping with no deadline)
+expiry_event = threading.Event()
+
+# Lock guarding the expiry heap (the transaction map has its own bucket locks)
+expiry_heap_lock = threading.Lock()
+
+# Worker pool for fanning out network calls (Bakong status checks and Telegram
+# notifications) concurrently. These are network-bound (the GIL is released
+# during socket I/O), so N calls cost ~1 round-trip instead of N. max_workers
+# also caps the number of in-flight requests so the APIs aren't flooded.
+worker_pool = ThreadPoolExecutor(max_workers=16)
+
+# Telegram rate-limit bookkeeping: ~30 messages/second overall and
+# 1 message/second per chat (per the Bot API guidelines)
+telegram_send_times = deque()
+telegram_chat_last_send = {}
+telegram_rate_lock = threading.Lock()
+
+# Stay safely under Telegram's 4096-character message cap when joining notices
+MAX_MESSAGE_CHARS = 4000
+
+def send_chat_digest(chat_id, lines):
+    """
+    Sends a list of notification lines to one chat, joined into as few messages
+    as the 4096-char cap allows. Coalescing K notices into one send amortizes
+    both the Telegram round-trip and the 1 msg/s per-chat rate budget.
+    """
+    chunk = []
+    chunk_len = 0
+    for line in lines:
+        if chunk and chunk_len + len(line) + 2 > MAX_MESSAGE_CHARS:
+            throttle_telegram_send(chat_id)
+            bot.send_message(chat_id, "\n\n".join(chunk), parse_mode="Markdown")
+            chunk = []
+            chunk_len = 0
+        chunk.append(line)
+        chunk_len += len(line) + 2
+    if chunk:
+        throttle_telegram_send(chat_id)
+        bot.send_message(chat_id, "\n\n".join(chunk), parse_mode="Markdown")
+
+def throttle_telegram_send(chat_id):
+    """
+    Blocks the calling worker until a Telegram send to chat_id fits within the
+    30 msg/s global and 1 msg/s per-chat limits, then records the send.
+    """
+    while True:
+        with telegram_rate_lock:
+            now = time.time()
+            # Drop global timestamps older than the 1-second window
+            while telegram_send_times and now - telegram_send_times[0] >= 1:
+                telegram_send_times.popleft()
+
+            last_chat_send = telegram_chat_last_send.get(chat_id, 0)
+            if now - last_chat_send < 1:
+                wait = 1 - (now - last_chat_send)
+            elif len(telegram_send_times) >= 30:
+                wait = 1 - (now - telegram_send_times[0])
+            else:
+                telegram_send_times.append(now)
+                telegram_chat_last_send[chat_id] = now
+                return
+        time.sleep(wait)
+
+# Shared keep-alive session for every Telegram API call. telebot otherwise
+# opens connections per thread/request, so each worker-pool burst pays fresh
+# TCP + TLS handshakes; one pooled session amortizes those across all calls
+# (pool sized to cover the 16 pool workers plus the handler threads).
+telegram_session = requests.Session()
+telegram_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+def _send_telegram_request(method, url, **kwargs):
+    return telegram_session.request(method, url, **kwargs)
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = _send_telegram_request
 
 # Initialize the Bot and the KHQR client
 bot = telebot.TeleBot(BOT_TOKEN)
@@ -53,112 +330,368 @@ except Exception as e:
     print(f"Error initializing KHQR client: {e}. Check your BAKONG_TOKEN.")
     khqr_client = None
 
-# --- UTILITY FUNCTION FOR PAYMENT CHECK ---
+# --- UTILITY FUNCTION FOR QR RENDERING ---
 
-def check_payment_status(bill_number, md5_hash, chat_id, message_id):
+@lru_cache(maxsize=256)
+def render_qr_image(qr_string):
     """
-    Checks the payment status for a specific transaction and handles success/failure.
-    Returns True if payment was confirmed and transaction was removed, False otherwise.
+    Renders a QR string to image bytes, caching the result keyed on the string.
+    The qrcode-encode + Pillow-rasterize pipeline is pure CPU work, so repeat
+    renders of the same payload (e.g. identical /pay amounts re-issued) return
+    the cached bytes in O(1) instead of re-running the encoder.
+    Returns the image bytes: lossless WebP when Pillow is available (smaller
+    and faster to encode than zlib-compressed PNG, so less CPU and a smaller
+    multipart upload), PNG otherwise.
     """
-    try:
-        payment_status = khqr_client.check_payment(md5_hash)
-        
-        if payment_status == "PAID":
-            # Payment confirmed!
-            
-            # 1. DELETE the QR code image message
-            if message_id:
-                try:
-                    bot.delete_message(chat_id, message_id)
-                    print(f"Deleted QR message {message_id} for successful payment {bill_number}.")
-                except Exception as delete_e:
-                    print(f"Failed to delete QR message {message_id}: {delete_e}")
-
-            # 2. Send the success confirmation message
-            bot.send_message(chat_id, 
-                f"🎉 **បានទូទាត់រួចរាល់ហើយ! (Payment Completed)**\n"
-                f"លេខបង្កាន់ដៃ: `{bill_number}`\n"
-                f"ស្ថានភាព: **{payment_status}**\n"
-                f"សូមអរគុណសម្រាប់ការទូទាត់!", 
-                parse_mode="Markdown"
-            )
-            
-            # 3. Remove from tracking dictionary
-            with transaction_lock:
-                if bill_number in active_transactions:
-                    del active_transactions[bill_number]
-                    print(f"Transaction {bill_number} removed from tracking after success.")
-
-            return True # Payment confirmed and cleaned up
+    png_bytes = khqr_client.qr_image(qr_string, format='bytes')
+    if Image is not None:
+        try:
+            webp_buffer = io.BytesIO()
+            Image.open(io.BytesIO(png_bytes)).save(webp_buffer, format='WEBP', lossless=True, method=0)
+            return webp_buffer.getvalue()
+        except Exception as webp_e:
+            print(f"WebP re-encode failed, falling back to PNG: {webp_e}")
+    return png_bytes
+
+# Telegram file_ids of QR images already uploaded once, keyed on the QR string.
+# A repeat payload is sent by file_id, skipping the multipart upload entirely.
+_qr_file_id_cache = {}
+_QR_FILE_ID_CACHE_MAX = 256
+
+# --- UTILITY FUNCTION FOR QR HASHING ---
+
+# Cached MD5 state for the stable KHQR prefix. The EMV TLV string opens with
+# the merchant fields (bank account, name, city, currency), which are identical
+# across payments, so that portion only needs to be hashed once and copied.
+_md5_prefix = b""
+_md5_prefix_state = hashlib.md5()
+_md5_last_qr = b""
+_md5_prefix_lock = threading.Lock()
+
+def generate_qr_md5(qr_string):
+    """
+    MD5 hex digest of a QR string (same result as khqr_client.generate_md5).
+    Reuses a cached hashlib state for the prefix shared with the previous
+    payment via md5.copy(), so only the varying suffix (amount, bill number,
+    CRC) is re-hashed on each /pay.
+    """
+    global _md5_prefix, _md5_prefix_state, _md5_last_qr
+    data = qr_string.encode('utf-8')
+    with _md5_prefix_lock:
+        if _md5_prefix and data.startswith(_md5_prefix):
+            digest = _md5_prefix_state.copy()
+            suffix = data[len(_md5_prefix):]
         else:
-            # Payment still UNPAID or other status
-            return False
+            # Re-derive the cached prefix as the common prefix with the
+            # previous QR string, then seed a fresh state for it
+            n = 0
+            for a, b in zip(_md5_last_qr, data):
+                if a != b:
+                    break
+                n += 1
+            _md5_prefix = data[:n]
+            _md5_prefix_state = hashlib.md5(_md5_prefix)
+            digest = _md5_prefix_state.copy()
+            suffix = data[n:]
+        _md5_last_qr = data
+    digest.update(suffix)
+    return digest.hexdigest()
 
-    except Exception as e:
+# --- UTILITY FUNCTION FOR PAYMENT CHECK ---
+
+def _check_payment_fast(bill_number, md5_hash):
+    """
+    Queries Bakong for the payment status. Returns the status string, or None
+    when the check failed with a network/API error. bakong_khqr wraps every
+    transport and API failure in ValueError, so only that is handled here; the
+    no-exception path stays a straight line of bytecode and anything
+    unexpected surfaces instead of being swallowed.
+    """
+    try:
+        return khqr_client.check_payment(md5_hash)
+    except ValueError as e:
         print(f"Error checking payment for {bill_number}: {e}")
-        # Notify the user that the manual check failed
+        return None
+
+def _handle_paid(bill_number, chat_id, message_id, payment_status, notifications=None):
+    """Success branch: deletes the QR message, notifies the user and untracks."""
+    # 1. DELETE the QR code image message
+    if message_id:
         try:
+            bot.delete_message(chat_id, message_id)
+            print(f"Deleted QR message {message_id} for successful payment {bill_number}.")
+        except Exception as delete_e:
+            print(f"Failed to delete QR message {message_id}: {delete_e}")
+
+    # 2. Send (or queue) the success confirmation message
+    success_text = (
+        f"🎉 **បានទូទាត់រួចរាល់ហើយ! (Payment Completed)**\n"
+        f"លេខបង្កាន់ដៃ: `{bill_number}`\n"
+        f"ស្ថានភាព: **{payment_status}**\n"
+        f"សូមអរគុណសម្រាប់ការទូទាត់!"
+    )
+    if notifications is not None:
+        # list.append is atomic under the GIL, safe across pool workers
+        notifications.append((chat_id, success_text))
+    else:
+        bot.send_message(chat_id, success_text, parse_mode="Markdown")
+
+    # 3. Remove from tracking
+    if pop_transaction(bill_number) is not None:
+        print(f"Transaction {bill_number} removed from tracking after success.")
+
+def check_payment_status(bill_number, md5_hash, chat_id, message_id, notifications=None):
+    """
+    Checks the payment status for a specific transaction and handles success/failure.
+    Returns True if payment was confirmed and transaction was removed, False otherwise.
+    When notifications is given (a shared list of (chat_id, text) pairs), the
+    success message is appended there instead of sent immediately, so the poll
+    tick can coalesce several confirmations per chat into one message.
+    """
+    payment_status = _check_payment_fast(bill_number, md5_hash)
+
+    if payment_status == "PAID":
+        # Payment confirmed!
+        _handle_paid(bill_number, chat_id, message_id, payment_status, notifications)
+        return True # Payment confirmed and cleaned up
+
+    if payment_status is None:
+        # The check itself failed; notify the user (best-effort)
+        with contextlib.suppress(telebot.apihelper.ApiException):
             bot.send_message(chat_id, "⚠️ **កំហុសត្រួតពិនិត្យ (Check Error):** មានបញ្ហាក្នុងការពិនិត្យស្ថានភាពទូទាត់។")
-        except:
-             pass # Ignore if this message also fails to send
-        return False
 
-# --- 2. THREADED AUTO-CONFIRMATION FUNCTION ---
+    # Payment still UNPAID or other status
+    return False
+
+# --- 2. THREADED AUTO-CONFIRMATION FUNCTIONS ---
+
+def hold_cleaner_lease():
+    """
+    Returns True if this worker currently holds (or just acquired) the cleanup
+    lease. With Redis-shared state only one worker at a time should run the
+    expiry/poll sweeps; the SETNX lease with a TTL elects one and lets another
+    take over if the holder dies. Without Redis there is a single process, so
+    the lease is always held. Best-effort: a brief overlap during handover is
+    possible and only costs a redundant sweep.
+    """
+    if redis_client is None:
+        return True
+    if redis_client.set(REDIS_CLEANER_LOCK_KEY, _WORKER_ID, nx=True, ex=CLEANER_LEASE_SECONDS):
+        return True
+    if redis_client.get(REDIS_CLEANER_LOCK_KEY) == _WORKER_ID:
+        # Still ours: refresh the TTL
+        redis_client.expire(REDIS_CLEANER_LOCK_KEY, CLEANER_LEASE_SECONDS)
+        return True
+    return False
+
+def pop_expired_transactions():
+    """
+    Removes and returns every transaction whose deadline has passed, as
+    ([(bill_number, data), ...], next_deadline). With Redis the due bills come
+    from one ZRANGEBYSCORE and are cleaned up in a single MULTI/EXEC pipeline;
+    otherwise they are popped off the in-process expiry heap.
+    """
+    current_time = time.time()
+    expired = []
+
+    if redis_client is not None:
+        due_bills = redis_client.zrangebyscore(REDIS_EXPIRY_KEY, 0, current_time)
+        if due_bills:
+            pipe = redis_client.pipeline()
+            for bill_number in due_bills:
+                pipe.hgetall(REDIS_TX_PREFIX + bill_number)
+                pipe.delete(REDIS_TX_PREFIX + bill_number)
+            pipe.zremrangebyscore(REDIS_EXPIRY_KEY, 0, current_time)
+            results = pipe.execute()
+            for i, bill_number in enumerate(due_bills):
+                mapping = results[2 * i]
+                if mapping:
+                    expired.append((bill_number, _decode_transaction(mapping)))
+        upcoming = redis_client.zrange(REDIS_EXPIRY_KEY, 0, 0, withscores=True)
+        next_deadline = upcoming[0][1] if upcoming else None
+        return expired, next_deadline
+
+    # Drain every due heap entry in one pass while holding only the heap lock,
+    # then resolve the records bucket-by-bucket outside it so the heap stays
+    # available to /pay while the (slower) map removals run
+    due_bills = []
+    with expiry_heap_lock:
+        while expiry_heap and expiry_heap[0][0] <= current_time:
+            expiry_time, bill_number = heapq.heappop(expiry_heap)
+            due_bills.append(bill_number)
+
+        # Peek at the next deadline (if any) before releasing the lock
+        next_deadline = expiry_heap[0][0] if expiry_heap else None
+
+    for bill_number in due_bills:
+        data = pop_transaction(bill_number)
+        if data is None:
+            # Stale heap entry: the transaction was already paid and removed
+            continue
+        expired.append((bill_number, data))
+    return expired, next_deadline
+
+def delete_qr_message(chat_id, message_id):
+    """Best-effort delete of a QR message (it may already be gone)."""
+    try:
+        bot.delete_message(chat_id, message_id)
+    except Exception as delete_e:
+        print(f"Failed to delete QR message {message_id}: {delete_e}")
+
+def expire_transactions():
+    """
+    Runs in a background thread to clean up expired transactions.
+    Sleeps until the earliest deadline on the expiry heap instead of waking on a
+    fixed timer, so expiry work is proportional to the number of transactions
+    that actually expired rather than the number being tracked.
+    """
+    while True:
+        if not hold_cleaner_lease():
+            # Another worker is running the sweeps; check back when its lease lapses
+            time.sleep(CLEANER_LEASE_SECONDS)
+            continue
+
+        # 1. Pop every transaction whose deadline has passed
+        expired, next_deadline = pop_expired_transactions()
+        for bill_number, data in expired:
+            print(f"Transaction {bill_number} removed from tracking after expiry.")
+
+        # 2. Outside the lock, delete the QR messages concurrently and coalesce
+        # the expiry notices so each chat gets one message per sweep instead of
+        # one per expired transaction
+        delete_futures = [
+            worker_pool.submit(delete_qr_message, data['chat_id'], data['message_id'])
+            for bill_number, data in expired if data.get('message_id')
+        ]
+        per_chat = {}
+        for bill_number, data in expired:
+            per_chat.setdefault(data['chat_id'], []).append(
+                f"❌ **ការទូទាត់ផុតកំណត់ (Expired)**\nលេខបង្កាន់ដៃ `{bill_number}` បានផុតកំណត់ក្នុងរយៈពេល 5 នាទីហើយ。\nសូមបង្កើត QR ថ្មីដើម្បីបង់ប្រាក់។"
+            )
+        notify_futures = [
+            worker_pool.submit(send_chat_digest, chat_id, lines)
+            for chat_id, lines in per_chat.items()
+        ]
+        for future in delete_futures + notify_futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Expiry notification worker failed: {e}")
+
+        # 3. Sleep until the next true deadline; if the heap is empty wait for
+        # /pay to signal that a new transaction was registered. With shared
+        # state the wait is capped so the lease gets refreshed while idle.
+        if next_deadline is None:
+            timeout = CLEANER_LEASE_SECONDS / 2 if redis_client is not None else None
+        else:
+            timeout = max(0, next_deadline - time.time())
+            if redis_client is not None:
+                timeout = min(timeout, CLEANER_LEASE_SECONDS / 2)
+        expiry_event.wait(timeout=timeout)
+        expiry_event.clear()
 
 def check_and_cleanup_transactions():
     """
-    Runs in a background thread to automatically check payment status and clean up expired transactions.
+    Runs in a background thread to automatically check payment status on a fixed cadence.
+    Expiry handling lives in expire_transactions(); this thread only polls Bakong.
+    With the payment webhook active this becomes a slow reconciliation sweep, since
+    PAID events normally arrive as pushes.
     """
+    poll_interval = RECONCILE_INTERVAL_SECONDS if PAYMENT_WEBHOOK_URL else CHECK_INTERVAL_SECONDS
     while True:
-        current_time = time.time()
-        transactions_to_remove = []
-        
-        # 1. Process active transactions
-        with transaction_lock:
-            # Create a list of items to iterate over
-            items_to_check = list(active_transactions.items())
-
-        for bill_number, data in items_to_check:
-            md5_hash = data['md5_hash']
-            chat_id = data['chat_id']
-            expiry_time = data['expiry_time']
-            message_id = data.get('message_id')
-            
-            # A. Check for expiration first
-            if expiry_time < current_time:
-                # Transaction has expired
-                
-                # Try to delete the QR message if it exists
-                if message_id:
-                    try:
-                        bot.delete_message(chat_id, message_id)
-                    except Exception as delete_e:
-                        print(f"Failed to delete expired QR message {message_id}: {delete_e}")
-
-                bot.send_message(chat_id, 
-                    f"❌ **ការទូទាត់ផុតកំណត់ (Expired)**\nលេខបង្កាន់ដៃ `{bill_number}` បានផុតកំណត់ក្នុងរយៈពេល 5 នាទីហើយ。\nសូមបង្កើត QR ថ្មីដើម្បីបង់ប្រាក់។", 
-                    parse_mode="Markdown"
-                )
-                transactions_to_remove.append(bill_number)
-                continue
-
-            # B. Check payment status for unexpired transactions
-            # This uses the utility function which handles success message and cleanup
-            payment_confirmed = check_payment_status(bill_number, md5_hash, chat_id, message_id)
-            if payment_confirmed:
-                # Add to removal list if the utility function confirmed payment and cleaned up
-                transactions_to_remove.append(bill_number)
-                
-        # 2. Remove transactions marked for removal
-        with transaction_lock:
-            for key in transactions_to_remove:
-                if key in active_transactions:
-                    # Double-check removal, though handled by utility function
-                    del active_transactions[key]
-                    print(f"Transaction {key} removed from tracking.")
-        
+        if not hold_cleaner_lease():
+            # Another worker is running the sweeps; check back when its lease lapses
+            time.sleep(CLEANER_LEASE_SECONDS)
+            continue
+
+        # Snapshot the active transactions to iterate without holding any lock
+        items_to_check = snapshot_transactions()
+
+        # Fan the status checks out across the worker pool instead of polling
+        # serially; check_payment_status handles removal and queues its success
+        # message on the shared accumulator for per-chat coalescing below
+        notifications = []
+        futures = {
+            worker_pool.submit(
+                check_payment_status, bill_number, data['md5_hash'], data['chat_id'],
+                data.get('message_id'), notifications
+            ): bill_number
+            for bill_number, data in items_to_check
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Payment check worker failed for {futures[future]}: {e}")
+
+        # Send the queued confirmations, one coalesced message per chat
+        per_chat = {}
+        for chat_id, text in notifications:
+            per_chat.setdefault(chat_id, []).append(text)
+        for chat_id, lines in per_chat.items():
+            try:
+                send_chat_digest(chat_id, lines)
+            except Exception as e:
+                print(f"Failed to send confirmation digest to chat {chat_id}: {e}")
+
         # Sleep until the next check
-        time.sleep(CHECK_INTERVAL_SECONDS)
+        time.sleep(poll_interval)
+
+# --- 2B. WEBHOOK SERVER (PUSH NOTIFICATIONS) ---
+
+if Flask is not None:
+    webhook_app = Flask(__name__)
+
+    @webhook_app.route('/bakong/webhook', methods=['POST'])
+    def bakong_webhook():
+        """
+        Receives push payment notifications from Bakong so PAID events are handled
+        immediately instead of waiting for the next poll tick. The notification is
+        only a trigger: the status is re-verified through check_payment_status, so
+        a forged POST cannot mark a transaction as paid.
+        """
+        payload = flask_request.get_json(silent=True) or {}
+        bill_number = payload.get('bill_number')
+        if not bill_number:
+            return {'status': 'ignored'}, 400
+
+        data = get_transaction(bill_number)
+        if data is None:
+            # Unknown or already-completed transaction
+            return {'status': 'unknown'}, 404
+
+        # Verify asynchronously so the webhook response isn't held up by Telegram calls
+        worker_pool.submit(
+            check_payment_status, bill_number, data['md5_hash'], data['chat_id'], data.get('message_id')
+        )
+        return {'status': 'ok'}, 200
+
+    # The token in the path keeps third parties from posting forged updates
+    @webhook_app.route('/webhook/' + BOT_TOKEN, methods=['POST'])
+    def telegram_webhook():
+        """
+        Receives bot updates pushed by Telegram, replacing the getUpdates
+        long-poll loop (and its per-iteration HTTPS round-trip) entirely.
+        """
+        update = telebot.types.Update.de_json(flask_request.stream.read().decode('utf-8'))
+        bot.process_new_updates([update])
+        return {'status': 'ok'}, 200
+else:
+    webhook_app = None
+
+def register_bakong_webhook():
+    """Registers the payment notification URL with Bakong."""
+    try:
+        khqr_client.register_webhook(PAYMENT_WEBHOOK_URL + '/bakong/webhook')
+        print(f"Registered Bakong payment webhook at {PAYMENT_WEBHOOK_URL}/bakong/webhook")
+    except Exception as e:
+        # Older bakong-khqr versions have no webhook registration; the endpoint
+        # still works if the URL is registered manually with the FI
+        print(f"Could not register Bakong webhook automatically: {e}")
+
+def serve_webhooks():
+    """Serves the flask webhook endpoints (blocks the calling thread)."""
+    webhook_app.run(host='0.0.0.0', port=WEBHOOK_PORT)
 
 # --- 3. BOT COMMAND HANDLERS ---
 
@@ -192,10 +725,10 @@ def generate_khqr_payment(message):
         description = parts[2] if len(parts) == 3 else f"Payment Ref {time.time():.0f}" 
         
         # 2. Generate a unique reference and calculate expiration time
-        bill_number = f"TRX{int(time.time() * 1000)}" 
+        bill_number = next_bill_number()
         expiry_time = time.time() + EXPIRATION_SECONDS
-        
-        expiry_datetime = time.strftime('%I:%M:%S %p', time.localtime(expiry_time))
+
+        expiry_datetime = format_expiry_time(expiry_time)
 
         bot.reply_to(message, f"កំពុងបង្កើត KHQR ទឹកប្រាក់ចំនួន {amount} {CURRENCY} (លេខបង្កាន់ដៃ `{bill_number}`)...")
 
@@ -213,60 +746,72 @@ def generate_khqr_payment(message):
             static=False 
         )
         
-        # 4. Generate MD5 hash 
-        md5_hash = khqr_client.generate_md5(qr_string)
+        # 4. Generate MD5 hash (prefix-cached; identical to khqr_client.generate_md5)
+        md5_hash = generate_qr_md5(qr_string)
+
+        # 5. Convert the QR string into an image (in memory, cached per payload);
+        # a cached Telegram file_id skips both the render and the upload.
+        # The raw bytes go straight to send_photo - wrapping them in a BytesIO
+        # only adds another copy of the blob for telebot to read back out.
+        cached_file_id = _qr_file_id_cache.get(qr_string)
+        if cached_file_id is None:
+            try:
+                photo_payload = render_qr_image(qr_string)
+            except Exception as img_e:
+                error_message = (
+                    f"❌ **កំហុសបង្កើតរូបភាព (Image Error):** មិនអាចបង្កើតរូបភាព QR បានទេ។\n"
+                    f"សូមដំឡើងកញ្ចប់ដែលត្រូវការ៖ `pip install \"bakong-khqr[image]\"`"
+                )
+                bot.reply_to(message, error_message)
+                print(f"Image generation failed: {img_e}")
+                return
+        else:
+            photo_payload = cached_file_id
 
-        # 5. Convert the QR string into an image (in memory)
-        try:
-            qr_image_bytes = khqr_client.qr_image(
-                qr_string, 
-                format='bytes'
-            )
-        except Exception as img_e:
-            error_message = (
-                f"❌ **កំហុសបង្កើតរូបភាព (Image Error):** មិនអាចបង្កើតរូបភាព QR បានទេ។\n"
-                f"សូមដំឡើងកញ្ចប់ដែលត្រូវការ៖ `pip install \"bakong-khqr[image]\"`"
-            )
-            bot.reply_to(message, error_message)
-            print(f"Image generation failed: {img_e}")
-            return
 
-        photo_file = io.BytesIO(qr_image_bytes)
-        photo_file.name = 'khqr_payment.png'
-        
         # 6. Create the Inline Keyboard with the 'Confirm Payment' button
         keyboard = types.InlineKeyboardMarkup()
-        # The callback_data includes the transaction bill_number
-        callback_data = f"{CONFIRM_CALLBACK_PREFIX}{bill_number}"
+        # The callback_data carries the bill id packed as compact base64
+        callback_data = encode_bill_callback(bill_number)
         confirm_button = types.InlineKeyboardButton("✅ Confirm Payment", callback_data=callback_data)
         keyboard.add(confirm_button)
 
         # 7. Send the QR code image and instructions
-        caption = (
-            f"💰 **អាចទូទាត់ជាមួយ KHQR ខាងលើបាន**\n"
-            f"ទឹកប្រាក់ចំនួន **{amount:.2f} {CURRENCY}**\n"
-            f"គោលបំណង: {description}\n"
-            f"លេខបង្កាន់ដៃ: `{bill_number}`\n"
-            f"⏰ **ផុតកំណត់នៅម៉ោង {expiry_datetime}**\n\n"
-            f"✅ **ការទូទាត់នឹងត្រូវបានបញ្ជាក់ដោយស្វ័យប្រវត្តិ ឬចុចប៊ូតុងខាងក្រោម។**"
+        caption = QR_CAPTION_TEMPLATE.format(
+            amount=amount,
+            description=description,
+            bill_number=bill_number,
+            expiry_datetime=expiry_datetime
         )
         # Capture the message object returned by send_photo
         sent_message = bot.send_photo(
-            message.chat.id, 
-            photo_file, 
-            caption=caption, 
+            message.chat.id,
+            photo_payload,
+            caption=caption,
             parse_mode="Markdown",
             reply_markup=keyboard # Attach the inline keyboard
         )
 
-        # 8. Store transaction data, including the message ID
-        with transaction_lock:
-            active_transactions[bill_number] = {
-                'md5_hash': md5_hash, 
-                'expiry_time': expiry_time,
-                'chat_id': message.chat.id,
-                'message_id': sent_message.message_id
-            }
+        # Remember the uploaded image's file_id so a repeat payload is re-sent
+        # by reference instead of uploading the bytes again
+        if cached_file_id is None and sent_message.photo:
+            if len(_qr_file_id_cache) >= _QR_FILE_ID_CACHE_MAX:
+                _qr_file_id_cache.clear()
+            _qr_file_id_cache[qr_string] = sent_message.photo[-1].file_id
+
+        # 8. Store transaction data, including the message ID, and register the expiry deadline
+        add_transaction(bill_number, {
+            'md5_hash': md5_hash,
+            'expiry_time': expiry_time,
+            'chat_id': message.chat.id,
+            'message_id': sent_message.message_id
+        })
+        if redis_client is None:
+            # With Redis the deadline already lives in the expiry sorted set
+            with expiry_heap_lock:
+                heapq.heappush(expiry_heap, (expiry_time, bill_number))
+        # Wake the expiry thread in case it was idle waiting for a deadline
+        expiry_event.set()
 
     except ValueError:
         bot.reply_to(message, "❌ **កំហុស:** ទម្រង់ទឹកប្រាក់មិនត្រឹមត្រូវ។ សូមបញ្ចូលលេខតែប៉ុណ្ណោះ។")
@@ -276,81 +821,115 @@ def generate_khqr_payment(message):
 
 # --- 4. CALLBACK QUERY HANDLER FOR THE PAYMENT BUTTON ---
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(CONFIRM_CALLBACK_PREFIX))
+@bot.callback_query_handler(func=lambda call: len(call.data) == BILL_CALLBACK_LEN)
 def handle_confirm_payment(call):
-    """Handles the 'Confirm Payment' button click."""
-    
-    # 1. Answer the callback query to stop the 'loading' animation on the button
-    bot.answer_callback_query(call.id, text="កំពុងពិនិត្យស្ថានភាព...")
-
-    # 2. Extract the bill number
-    bill_number = call.data[len(CONFIRM_CALLBACK_PREFIX):]
-    
-    # 3. Check if the transaction is still active
-    with transaction_lock:
-        if bill_number not in active_transactions:
-            # Edit the message to reflect that the payment is no longer valid or was completed
-            try:
-                bot.edit_message_caption(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    caption=call.message.caption + "\n\n**⚠️ ការទូទាត់នេះលែងត្រួតពិនិត្យបានហើយ (Expired/Completed).**",
-                    parse_mode="Markdown",
-                    reply_markup=None # Remove the keyboard
-                )
-            except Exception as e:
-                # This often fails if the message was already deleted by the cleanup thread
-                print(f"Failed to edit expired/completed message: {e}")
-            
-            bot.send_message(call.message.chat.id, 
-                f"❌ **លេខបង្កាន់ដៃ `{bill_number}` មិនត្រូវបានតាមដានទៀតទេ។** (ប្រហែលជាផុតកំណត់ ឬបានទូទាត់រួចហើយ)",
-                parse_mode="Markdown"
-            )
-            return
+    """
+    Handles the 'Confirm Payment' button click.
+    The callback query is answered exactly once, after the status is known, so
+    each click costs a single Telegram round-trip for the user-visible feedback.
+    """
 
-        # Get transaction data
-        data = active_transactions.get(bill_number)
-        md5_hash = data['md5_hash']
-        chat_id = data['chat_id']
-        message_id = data['message_id']
-        
-    # 4. Perform the manual payment check
-    payment_confirmed = check_payment_status(bill_number, md5_hash, chat_id, message_id)
+    # 1. Unpack the bill number from the compact callback payload
+    bill_number = decode_bill_callback(call.data)
 
-    if not payment_confirmed:
-        # If not confirmed, provide feedback to the user and update the button to prevent spam
+    # 2. Check if the transaction is still active
+    data = get_transaction(bill_number)
+    if data is None:
+        # Edit the message to reflect that the payment is no longer valid or was completed
         try:
-             # Edit the caption to show status
-            new_caption = call.message.caption.split('✅ **ការទូទាត់')[0] # Remove the existing status line
-            new_caption += f"🔴 **ស្ថានភាពបច្ចុប្បន្ន: មិនទាន់បង់ប្រាក់ ❌ (UNPAID)**\n"
-            new_caption += "❌ **ការទូទាត់នឹងត្រូវបានបញ្ជាក់ដោយស្វ័យប្រវត្តិ ឬចុចប៊ូតុងខាងក្រោម។**"
-            
-            # Re-attach the same keyboard
             bot.edit_message_caption(
-                chat_id=chat_id,
-                message_id=message_id,
-                caption=new_caption,
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                caption=call.message.caption + "\n\n**⚠️ ការទូទាត់នេះលែងត្រួតពិនិត្យបានហើយ (Expired/Completed).**",
                 parse_mode="Markdown",
-                reply_markup=call.message.reply_markup
+                reply_markup=None # Remove the keyboard
             )
         except Exception as e:
-            print(f"Failed to edit caption after manual check: {e}")
-            
-        bot.send_message(chat_id, f"🔴 **លេខបង្កាន់ដៃ `{bill_number}`:** មិនទាន់បានទូទាត់ទេ។ សូមព្យាយាមម្តងទៀតក្នុងរយៈពេលខ្លី។")
+            # This often fails if the message was already deleted by the cleanup thread
+            print(f"Failed to edit expired/completed message: {e}")
 
+        bot.answer_callback_query(call.id,
+            text=f"❌ លេខបង្កាន់ដៃ {bill_number} មិនត្រូវបានតាមដានទៀតទេ។ (ប្រហែលជាផុតកំណត់ ឬបានទូទាត់រួចហើយ)",
+            show_alert=True
+        )
+        return
 
-# --- 5. START BOT POLLING & AUTO-CONFIRMATION THREAD ---
+    md5_hash = data['md5_hash']
+    chat_id = data['chat_id']
+    message_id = data['message_id']
+
+    # 3. Perform the manual payment check
+    payment_confirmed = check_payment_status(bill_number, md5_hash, chat_id, message_id)
+
+    if payment_confirmed:
+        # The success message was already sent; just acknowledge the click
+        bot.answer_callback_query(call.id, text="🎉 បានទូទាត់រួចរាល់ហើយ!")
+    else:
+        # Show the UNPAID status as a native popup: a single round-trip instead of
+        # the old answer + edit-caption + send-message sequence, and no spam in the chat
+        bot.answer_callback_query(call.id,
+            text=f"🔴 {bill_number}: មិនទាន់បានទូទាត់ទេ។ សូមព្យាយាមម្តងទៀតក្នុងរយៈពេលខ្លី។",
+            show_alert=True
+        )
+
+
+# --- 5. START BOT (WEBHOOK OR POLLING) & AUTO-CONFIRMATION THREADS ---
+
+def start_background_threads():
+    """Starts this process's expiry and auto-confirmation threads."""
+    expiry_thread = threading.Thread(target=expire_transactions, daemon=True)
+    expiry_thread.start()
+    print("Background expiry thread started.")
 
-if __name__ == '__main__':
-    # Start the background thread for auto-confirmation
     cleanup_thread = threading.Thread(target=check_and_cleanup_transactions, daemon=True)
     cleanup_thread.start()
     print("Background auto-confirmation thread started.")
 
-    print("Bot is starting polling...")
-    try:
-        # Start the main bot polling loop
-        bot.polling(none_stop=True)
-    except Exception as e:
-        print(f"Error during bot polling: {e}")
-  
+# --- 5B. WSGI ENTRY POINT FOR MULTI-WORKER DEPLOYMENT ---
+# One interpreter caps the bot at a single core for QR encoding, hashing and
+# JSON parsing. To scale out, point REDIS_URL at a shared Redis, set
+# TELEGRAM_WEBHOOK_URL (and optionally PAYMENT_WEBHOOK_URL) to the public URL
+# of a load balancer in front of the workers, register the webhooks once, then
+# serve this module's `app` with N workers, e.g.:
+#   ln -s 'Bakong@Wing.py' bakong_wing.py
+#   gunicorn -w 4 -b 0.0.0.0:8080 'bakong_wing:app'
+# Every worker handles updates; the Redis cleaner lease elects one at a time
+# to run the background sweeps.
+app = webhook_app
+
+if __name__ != '__main__' and webhook_app is not None:
+    # Imported by a WSGI server (e.g. a gunicorn worker): start this worker's
+    # background threads; the cleaner lease keeps the sweeps single-flight
+    start_background_threads()
+
+if __name__ == '__main__':
+    start_background_threads()
+
+    if (PAYMENT_WEBHOOK_URL or TELEGRAM_WEBHOOK_URL) and Flask is None:
+        print("A webhook URL is set but flask is not installed; falling back to polling only.")
+
+    if PAYMENT_WEBHOOK_URL and Flask is not None:
+        # PAID then arrives as a push event; the poll thread only runs as a
+        # slow reconciliation sweep
+        register_bakong_webhook()
+
+    if TELEGRAM_WEBHOOK_URL and Flask is not None:
+        # Webhook mode: Telegram pushes updates to the flask server, so there
+        # is no getUpdates long-poll loop at all
+        bot.remove_webhook()
+        bot.set_webhook(url=TELEGRAM_WEBHOOK_URL + '/webhook/' + BOT_TOKEN)
+        print("Bot is starting in webhook mode...")
+        serve_webhooks()
+    else:
+        # Polling mode: serve the Bakong endpoint (if any) on the side
+        if PAYMENT_WEBHOOK_URL and Flask is not None:
+            webhook_thread = threading.Thread(target=serve_webhooks, daemon=True)
+            webhook_thread.start()
+            print("Payment webhook server started.")
+
+        print("Bot is starting polling...")
+        try:
+            # Start the main bot polling loop
+            bot.polling(none_stop=True)
+        except Exception as e:
+            print(f"Error during bot polling: {e}")